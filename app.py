@@ -1,3 +1,5 @@
+import gzip
+import hmac
 import os
 import re
 import uuid
@@ -22,6 +24,7 @@ from sqlalchemy import (
     desc,
     asc,
     func,
+    event,
 )
 from sqlalchemy.orm import sessionmaker, DeclarativeBase, relationship, Session
 from fastapi.responses import HTMLResponse
@@ -30,10 +33,9 @@ from sqlalchemy.orm import Session
 from sqlalchemy import select, desc
 import re
 from datetime import datetime, timezone, timedelta
-from io import BytesIO
 
 import openpyxl
-from fastapi import UploadFile, File, Form
+from fastapi import UploadFile, File, Form, Body
 
 # =========================================================
 # CONFIG
@@ -44,10 +46,27 @@ from fastapi import UploadFile, File, Form
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./insure.db")
 
 connect_args = {}
+pool_args = {}
 if DATABASE_URL.startswith("sqlite"):
     connect_args = {"check_same_thread": False}
+else:
+    # Pool is per process: keep WEB_CONCURRENCY x (size + overflow) under the server's connection limit
+    pool_args = {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+    }
+
+engine = create_engine(DATABASE_URL, pool_pre_ping=True, connect_args=connect_args, **pool_args)
+
+if DATABASE_URL.startswith("sqlite"):
+    @event.listens_for(engine, "connect")
+    def _sqlite_pragmas(dbapi_conn, _record):
+        # WAL: dashboard reads don't block behind webhook writes (and vice versa)
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.close()
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True, connect_args=connect_args)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 
 app = FastAPI(title="Policy Lookup + Dashboard + Team Inbox + WhatsApp Delivery (Single File)")
@@ -66,6 +85,9 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4.1-mini")
 OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "25"))
 
+# Shared HTTP session: reuses pooled TLS connections to Graph/OpenAI instead of a new handshake per call
+HTTP = requests.Session()
+
 
 
 class Base(DeclarativeBase):
@@ -107,7 +129,7 @@ def send_whatsapp_text(to_number: str, body: str) -> dict:
         "text": {"body": body},
     }
 
-    r = requests.post(url, headers=headers, json=payload, timeout=30)
+    r = HTTP.post(url, headers=headers, json=payload, timeout=30)
     if r.status_code >= 400:
         raise RuntimeError(f"WhatsApp send failed: {r.status_code} {r.text}")
     return r.json()
@@ -163,16 +185,16 @@ def openai_generate_reply(*, customer_phone: str, customer_name: str | None, use
         # Total premium paid (sum of successful/paid payments)
         total_paid = 0.0
         try:
-            paid_rows = db.execute(
-                select(Payment).where(Payment.policy_id == pol.id).order_by(desc(Payment.paid_on), desc(Payment.created_at))
-            ).scalars().all()
-            for p in paid_rows:
-                st = (getattr(p, "status", "") or "").upper()
-                if st in ("PAID", "SUCCESS", "COMPLETED") or st == "":
-                    try:
-                        total_paid += float(getattr(p, "amount", 0) or 0)
-                    except Exception:
-                        pass
+            # Aggregate in SQL instead of loading every payment row and summing in Python
+            total_paid = float(
+                db.execute(
+                    select(func.coalesce(func.sum(Payment.amount), 0)).where(
+                        Payment.policy_id == pol.id,
+                        func.upper(func.coalesce(Payment.status, "")).in_(("PAID", "SUCCESS", "COMPLETED", "")),
+                    )
+                ).scalar_one()
+                or 0
+            )
         except Exception:
             total_paid = 0.0
 
@@ -354,7 +376,7 @@ def openai_generate_reply(*, customer_phone: str, customer_name: str | None, use
     }
 
     try:
-        r = requests.post(
+        r = HTTP.post(
             "https://api.openai.com/v1/responses",
             headers={"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"},
             json=payload,
@@ -487,7 +509,7 @@ class AuditLog(Base):
     customer_phone = Column(Text, nullable=True)
     success = Column(Boolean, nullable=False, default=False)
     reason = Column(Text, nullable=True)
-    created_at = Column(DateTime, default=now_utc, nullable=False)
+    created_at = Column(DateTime, default=now_utc, nullable=False, index=True)
 
 
 # -------- Team Inbox: users, conversations, messages --------
@@ -658,22 +680,25 @@ def whatsapp_verify(request: Request):
     token = request.query_params.get("hub.verify_token")
     challenge = request.query_params.get("hub.challenge")
 
-    if mode == "subscribe" and token and token == WHATSAPP_VERIFY_TOKEN:
+    # constant-time compare so the verify token can't be probed via response timing
+    if mode == "subscribe" and token and hmac.compare_digest(token.encode(), WHATSAPP_VERIFY_TOKEN.encode()):
         return HTMLResponse(content=str(challenge), status_code=200)
 
     return HTMLResponse(content="Verification failed", status_code=403)
 
 
 @app.post("/webhook")
-async def whatsapp_incoming(request: Request, db: Session = Depends(get_db)):
+def whatsapp_incoming(data: dict = Body(...), db: Session = Depends(get_db)):
     """
     Receives WhatsApp webhook payloads and ingests messages into Team Inbox.
     Auto-reply (OpenAI) is enabled below; everything else stays the same.
+
+    Declared as a plain def so FastAPI runs it in the threadpool: the DB
+    writes and Graph/OpenAI HTTP calls below are blocking and would
+    otherwise stall the event loop for every other request.
     """
     print(">>> META POST /webhook HIT <<<")
 
-    data = await request.json()
-
     handled = 0
 
     try:
@@ -710,6 +735,8 @@ async def whatsapp_incoming(request: Request, db: Session = Depends(get_db)):
                     if m:
                         policy_number = m.group(1)
 
+                    ts = now_utc()  # one timestamp for the whole ingest step
+
                     # find existing conversation by channel + phone that is not CLOSED (prefer open)
                     conv = db.execute(
                         select(InboxConversation)
@@ -730,8 +757,8 @@ async def whatsapp_incoming(request: Request, db: Session = Depends(get_db)):
                             policy_number=policy_number,
                             status="OPEN",
                             priority="NORMAL",
-                            last_message_at=now_utc(),
-                            updated_at=now_utc(),
+                            last_message_at=ts,
+                            updated_at=ts,
                         )
                         db.add(conv)
                         db.commit()
@@ -743,8 +770,8 @@ async def whatsapp_incoming(request: Request, db: Session = Depends(get_db)):
                     if policy_number and not conv.policy_number:
                         conv.policy_number = policy_number
 
-                    conv.last_message_at = now_utc()
-                    conv.updated_at = now_utc()
+                    conv.last_message_at = ts
+                    conv.updated_at = ts
 
                     db.add(
                         InboxMessage(
@@ -752,7 +779,7 @@ async def whatsapp_incoming(request: Request, db: Session = Depends(get_db)):
                             direction="IN",
                             body=text_body or "[empty]",
                             actor_user_id=None,
-                            created_at=now_utc(),
+                            created_at=ts,
                         )
                     )
 
@@ -779,13 +806,14 @@ async def whatsapp_incoming(request: Request, db: Session = Depends(get_db)):
                             if re.search(r"(agent|human|representative|advisor|support|call me|callback|talk to|speak to)", user_clean, flags=re.I):
                                 try:
                                     conv.status = "PENDING"
-                                    conv.updated_at = now_utc()
-                                    conv.last_message_at = now_utc()
+                                    conv.updated_at = ts
+                                    conv.last_message_at = ts
                                     handoff_msg = "Sure — I’m connecting you to a human advisor at Nath Investments. An agent will reply shortly."
 
                                     # Deliver to WhatsApp
                                     send_whatsapp_text(customer_phone, handoff_msg)
 
+                                    out_ts = now_utc()
                                     # Store OUT message in the same conversation thread
                                     db.add(
                                         InboxMessage(
@@ -793,11 +821,11 @@ async def whatsapp_incoming(request: Request, db: Session = Depends(get_db)):
                                             direction="OUT",
                                             body=handoff_msg,
                                             actor_user_id=None,
-                                            created_at=now_utc(),
+                                            created_at=out_ts,
                                         )
                                     )
-                                    conv.last_message_at = now_utc()
-                                    conv.updated_at = now_utc()
+                                    conv.last_message_at = out_ts
+                                    conv.updated_at = out_ts
 
                                     audit(
                                         db,
@@ -828,6 +856,7 @@ async def whatsapp_incoming(request: Request, db: Session = Depends(get_db)):
                                 # Deliver to WhatsApp
                                 send_whatsapp_text(customer_phone, reply)
 
+                                out_ts = now_utc()
                                 # Store OUT message in the same conversation thread
                                 db.add(
                                     InboxMessage(
@@ -835,11 +864,11 @@ async def whatsapp_incoming(request: Request, db: Session = Depends(get_db)):
                                         direction="OUT",
                                         body=reply,
                                         actor_user_id=None,
-                                        created_at=now_utc(),
+                                        created_at=out_ts,
                                     )
                                 )
-                                conv.last_message_at = now_utc()
-                                conv.updated_at = now_utc()
+                                conv.last_message_at = out_ts
+                                conv.updated_at = out_ts
 
                                 audit(
                                     db,
@@ -1044,7 +1073,7 @@ def admin_list_policies(q: Optional[str] = None, limit: int = 50, db: Session =
 
 
 @app.post("/admin/policies/upload")
-async def admin_upload_policies_excel(
+def admin_upload_policies_excel(
     file: UploadFile = File(...),
     dry_run: bool = Form(False),
     db: Session = Depends(get_db),
@@ -1068,9 +1097,9 @@ async def admin_upload_policies_excel(
       - payment_paid_on, payment_amount, payment_status, payment_reference_id, payment_method, payment_notes
 
     Rows with an existing policy_number are skipped (to avoid unexpected overwrites).
-    """
 
-    content = await file.read()
+    Runs in the threadpool (plain def) since workbook parsing and DB writes are blocking.
+    """
 
     def _norm(s: str) -> str:
         return re.sub(r"\s+", "_", (s or "").strip().lower())
@@ -1102,20 +1131,35 @@ async def admin_upload_policies_excel(
             except Exception:
                 return None
 
-    # Load workbook safely from bytes
+    # Load workbook straight from the upload's spooled file (no full in-memory copy);
+    # read-only mode streams rows instead of building the whole sheet in memory
     try:
-        wb = openpyxl.load_workbook(filename=BytesIO(content), data_only=True)
+        file.file.seek(0)
+        wb = openpyxl.load_workbook(filename=file.file, read_only=True, data_only=True)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Invalid Excel file (.xlsx required): {e}")
 
-    ws = wb.active
-    rows = list(ws.iter_rows(values_only=True))
-    if not rows:
-        raise HTTPException(status_code=400, detail="Excel sheet is empty")
-
-    header = [(_norm(str(c)) if c is not None else "") for c in rows[0]]
-    if not any(header):
-        raise HTTPException(status_code=400, detail="Header row is empty")
+    parsed_rows = []
+    try:
+        ws = wb.active
+        # read-only mode trusts the sheet's <dimension> tag, which some exporters write wrong
+        ws.reset_dimensions()
+        row_iter = ws.iter_rows(values_only=True)
+        first_row = next(row_iter, None)
+        if first_row is None:
+            raise HTTPException(status_code=400, detail="Excel sheet is empty")
+
+        header = [(_norm(str(c)) if c is not None else "") for c in first_row]
+        if not any(header):
+            raise HTTPException(status_code=400, detail="Header row is empty")
+
+        for r_idx, row in enumerate(row_iter, start=2):
+            d = {header[i]: row[i] for i in range(min(len(header), len(row)))}
+            if not any(v not in (None, "") for v in d.values()):
+                continue
+            parsed_rows.append((r_idx, d))
+    finally:
+        wb.close()
 
     # Build row dicts
     created_customers = 0
@@ -1131,12 +1175,23 @@ async def admin_upload_policies_excel(
                 return d[k]
         return None
 
-    for r_idx, row in enumerate(rows[1:], start=2):
-        d = {header[i]: row[i] for i in range(min(len(header), len(row)))}
-        if not any(v not in (None, "") for v in d.values()):
-            continue
+    # Resolve existing policy numbers in a few batched queries instead of one query per row
+    sheet_pns = list({
+        str(pn).strip()
+        for pn in (get(d, "policy_number", "policy", "policy_no", "policyno") for _, d in parsed_rows)
+        if pn is not None and str(pn).strip()
+    })
+    existing_pns = set()
+    for i in range(0, len(sheet_pns), 500):
+        existing_pns.update(
+            db.execute(
+                select(Policy.policy_number).where(Policy.policy_number.in_(sheet_pns[i:i + 500]))
+            ).scalars().all()
+        )
 
+    for r_idx, d in parsed_rows:
         try:
+            row_ts = now_utc()
             customer_full_name = get(d, "customer_full_name", "full_name", "name")
             customer_phone = get(d, "customer_phone_e164", "phone_e164", "customer_phone", "phone")
             customer_email = get(d, "customer_email", "email")
@@ -1176,8 +1231,8 @@ async def admin_upload_policies_excel(
                         email=(str(customer_email).strip() if customer_email else None),
                         dob=_as_date(get(d, "customer_dob", "dob")),
                         pan_last4=(str(get(d, "customer_pan_last4", "pan_last4")).strip() if get(d, "customer_pan_last4", "pan_last4") else None),
-                        created_at=now_utc(),
-                        updated_at=now_utc(),
+                        created_at=row_ts,
+                        updated_at=row_ts,
                     )
                     db.add(cust)
                     db.flush()
@@ -1195,11 +1250,10 @@ async def admin_upload_policies_excel(
                         cust.dob = _as_date(get(d, "customer_dob", "dob"))
                     if get(d, "customer_pan_last4", "pan_last4") and not cust.pan_last4:
                         cust.pan_last4 = str(get(d, "customer_pan_last4", "pan_last4")).strip()[:4]
-                    cust.updated_at = now_utc()
+                    cust.updated_at = row_ts
 
             # Skip existing policy to avoid overwrites
-            existing = db.execute(select(Policy).where(Policy.policy_number == policy_number)).scalars().first()
-            if existing:
+            if policy_number in existing_pns:
                 skipped_existing_policy += 1
                 continue
 
@@ -1221,8 +1275,8 @@ async def admin_upload_policies_excel(
                 grace_period_days=str(get(d, "grace_period_days") or "30").strip(),
                 nominee_name=(str(get(d, "nominee_name")).strip() if get(d, "nominee_name") else None),
                 nominee_relation=(str(get(d, "nominee_relation")).strip() if get(d, "nominee_relation") else None),
-                created_at=now_utc(),
-                updated_at=now_utc(),
+                created_at=row_ts,
+                updated_at=row_ts,
             )
 
             if dry_run:
@@ -1235,6 +1289,7 @@ async def admin_upload_policies_excel(
                 pol = Policy(customer_id=cust.id, **policy_kwargs)
                 db.add(pol)
                 db.flush()
+                existing_pns.add(policy_number)
                 created_policies += 1
                 policy_id = pol.id
 
@@ -1250,7 +1305,7 @@ async def admin_upload_policies_excel(
                             amount=sched_amt,
                             is_paid=is_paid,
                             paid_on=_as_date(get(d, "schedule_paid_on")),
-                            created_at=now_utc(),
+                            created_at=row_ts,
                         )
                     )
                     created_schedule += 1
@@ -1268,7 +1323,7 @@ async def admin_upload_policies_excel(
                             reference_id=(str(get(d, "payment_reference_id")).strip() if get(d, "payment_reference_id") else None),
                             method=(str(get(d, "payment_method")).strip() if get(d, "payment_method") else None),
                             notes=(str(get(d, "payment_notes")).strip() if get(d, "payment_notes") else None),
-                            created_at=now_utc(),
+                            created_at=row_ts,
                         )
                     )
                     created_payments += 1
@@ -1365,8 +1420,14 @@ def admin_inbox_conversations(
         )
 
     items = db.execute(stmt).scalars().all()
-    users = db.execute(select(TeamUser)).scalars().all()
-    user_map = {u.id: u.full_name for u in users}
+
+    # Only resolve names for users referenced on this page, not the whole team table
+    user_ids = {c.assigned_to_user_id for c in items if c.assigned_to_user_id}
+    user_map = {}
+    if user_ids:
+        user_map = dict(
+            db.execute(select(TeamUser.id, TeamUser.full_name).where(TeamUser.id.in_(user_ids))).all()
+        )
 
     return {
         "items": [{
@@ -1394,8 +1455,15 @@ def admin_inbox_conversation_detail(conversation_id: str, db: Session = Depends(
         select(InboxMessage).where(InboxMessage.conversation_id == conversation_id).order_by(asc(InboxMessage.created_at))
     ).scalars().all()
 
-    users = db.execute(select(TeamUser)).scalars().all()
-    user_map = {u.id: {"name": u.full_name, "role": u.role} for u in users}
+    user_ids = {m.actor_user_id for m in msgs if m.actor_user_id}
+    if conv.assigned_to_user_id:
+        user_ids.add(conv.assigned_to_user_id)
+    user_map = {}
+    if user_ids:
+        rows = db.execute(
+            select(TeamUser.id, TeamUser.full_name, TeamUser.role).where(TeamUser.id.in_(user_ids))
+        ).all()
+        user_map = {uid: {"name": name, "role": role} for uid, name, role in rows}
 
     return {
         "conversation": {
@@ -1488,6 +1556,7 @@ def admin_inbox_send(conversation_id: str, payload: InboxSendRequest, db: Sessio
             # don't store message if delivery failed
             raise HTTPException(status_code=502, detail=f"WhatsApp delivery failed: {str(e)}")
 
+    ts = now_utc()
     # Store message in thread (history)
     db.add(
         InboxMessage(
@@ -1495,12 +1564,12 @@ def admin_inbox_send(conversation_id: str, payload: InboxSendRequest, db: Sessio
             direction=direction,
             body=text,
             actor_user_id=actor_id,
-            created_at=now_utc(),
+            created_at=ts,
         )
     )
 
-    conv.last_message_at = now_utc()
-    conv.updated_at = now_utc()
+    conv.last_message_at = ts
+    conv.updated_at = ts
     db.commit()
 
     return {"ok": True, "whatsapp_result": wa_result}
@@ -2135,13 +2204,19 @@ DASHBOARD_HTML = r"""
     const data = await resp.json();
     teamUsers = data.items || [];
 
-    $("acting_user").innerHTML = teamUsers.map(u => `<option value="${u.id}">${u.full_name} (${u.role})</option>`).join("");
-    $("assign_to").innerHTML = `<option value="">UNASSIGNED</option>` + teamUsers.map(u => `<option value="${u.id}">${u.full_name}</option>`).join("");
+    // single pass over the team: build both option lists together
+    let acting = "", named = "";
+    for(const u of teamUsers){
+      acting += `<option value="${u.id}">${u.full_name} (${u.role})</option>`;
+      named += `<option value="${u.id}">${u.full_name}</option>`;
+    }
+
+    $("acting_user").innerHTML = acting;
+    $("assign_to").innerHTML = `<option value="">UNASSIGNED</option>` + named;
 
     const filt = $("inbox_assigned");
     const base = `<option value="">ALL</option><option value="unassigned">UNASSIGNED</option>`;
-    const more = teamUsers.map(u => `<option value="${u.id}">${u.full_name}</option>`).join("");
-    filt.innerHTML = base + more;
+    filt.innerHTML = base + named;
   }
 
   function debouncedRefreshInbox(){
@@ -2187,7 +2262,7 @@ DASHBOARD_HTML = r"""
         const line2 = `${c.customer_phone} • ${safe(c.policy_number)}`;
         const asg = c.assigned_to_name ? `Assigned: ${c.assigned_to_name}` : "Unassigned";
         return `
-          <div class="convItem ${active}" onclick="openConv('${c.id}')">
+          <div class="convItem ${active}" data-id="${c.id}" onclick="openConv('${c.id}')">
             <div class="convTop">
               <div class="convName">${title}</div>
               ${statusChip(c.status)}
@@ -2208,7 +2283,10 @@ DASHBOARD_HTML = r"""
 
   async function openConv(id){
     selectedConvId = id;
-    await refreshInbox(); // easy re-render to highlight active
+    // highlight in place instead of re-fetching the whole conversation list
+    document.querySelectorAll("#conv_list .convItem").forEach(el => {
+      el.classList.toggle("active", el.dataset.id === id);
+    });
     await loadConvDetail();
   }
 
@@ -2368,10 +2446,20 @@ DASHBOARD_HTML = r"""
 """
 
 
+# Rendered + gzipped once at import: the page only depends on DATABASE_URL
+DASHBOARD_BODY = DASHBOARD_HTML.replace("{{DBURL}}", DATABASE_URL).encode("utf-8")
+DASHBOARD_BODY_GZ = gzip.compress(DASHBOARD_BODY)
+
+
 @app.get("/dashboard", response_class=HTMLResponse)
-def dashboard():
-    html = DASHBOARD_HTML.replace("{{DBURL}}", DATABASE_URL)
-    return HTMLResponse(content=html, status_code=200)
+def dashboard(request: Request):
+    if "gzip" in request.headers.get("accept-encoding", "").lower():
+        return HTMLResponse(
+            content=DASHBOARD_BODY_GZ,
+            status_code=200,
+            headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"},
+        )
+    return HTMLResponse(content=DASHBOARD_BODY, status_code=200, headers={"Vary": "Accept-Encoding"})
 
 
 @app.get("/privacy", response_class=HTMLResponse)